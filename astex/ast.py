@@ -1,7 +1,7 @@
+import heapq
 import re
-import copy
+import sys
 from typing import List, Optional, Any
-from collections import deque
 
 
 __all__ = ['Node', 'GroupNode', 'TextNode', 'CommandNode', 'CommentNode', 'WhitespaceNode',
@@ -12,12 +12,13 @@ MAX_RECURSE_LEVEL = 256
 
 # Simple tokenizer implementation
 class Token:
-    def __init__(self, pattern, text, start, end, groups):
+    def __init__(self, pattern, text, start, end, groups, lastgroup=None):
         self.pattern = pattern
         self.text = text
         self.start: int = start
         self.end: int = end
         self.groups = groups
+        self.lastgroup: Optional[str] = lastgroup
 
     def get_text(self):
         return self.text[self.start:self.end]
@@ -28,48 +29,215 @@ class NoMatch(Token):
         super(NoMatch, self).__init__(None, text, start, end, None)
 
 
+def _name_patterns(patterns):
+    if isinstance(patterns, dict):
+        return patterns
+
+    # Keep the standard names for the built-in token patterns so to_ast can dispatch on them
+    names = {p: name for name, p in GROUP_TO_PATTERN.items()}
+    return {names.get(p, f"token{i}"): p for i, p in enumerate(patterns)}
+
+
+# Inline flag letters that can be scoped to a single alternative of a combined regex
+_SCOPED_FLAGS = ((re.ASCII, 'a'), (re.IGNORECASE, 'i'), (re.MULTILINE, 'm'), (re.DOTALL, 's'), (re.VERBOSE, 'x'))
+
+# Backreferences and conditionals, which refer to groups by number or name
+_GROUP_REFERENCE = re.compile(r"(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?P=|\(\?\()")
+
+
+def _combine_patterns(patterns):
+    """Combine patterns into a single alternation regex of named groups.  patterns is either a dict mapping group
+    names to patterns or a list of patterns, which are named token0, token1, etc. unless they are one of the
+    TOKEN_* patterns, in which case their name in GROUP_TO_PATTERN is used.  Earlier patterns take priority
+    when two tokens start at the same position, and each pattern keeps its own flags.  Returns None if the patterns
+    can't be combined, because one of them uses named groups, backreferences or global inline flags."""
+    alternatives = []
+    for name, p in _name_patterns(patterns).items():
+        if p.groupindex or _GROUP_REFERENCE.search(p.pattern):
+            return None
+
+        flags = ''.join(letter for flag, letter in _SCOPED_FLAGS if p.flags & flag)
+        alternatives.append(f"(?P<{name}>(?{flags}:{p.pattern}))" if flags else f"(?P<{name}>{p.pattern})")
+
+    try:
+        return re.compile('|'.join(alternatives))
+    except re.error:
+        return None
+
+
+class _SeparateMatch:
+    """A match found by matching patterns one at a time, with the parts of the interface of a match of a combined
+    regex used by Tokenizer."""
+    __slots__ = ('lastgroup', 'match')
+
+    def __init__(self, lastgroup, match):
+        self.lastgroup = lastgroup
+        self.match = match
+
+    def span(self):
+        return self.match.span()
+
+    def groups(self):
+        return self.match.groups()
+
+
 class Tokenizer:
     def __init__(self, patterns):
-        self.patterns: List[re.Pattern] = patterns
-        self._left_over = ''
+        """Create a tokenizer from either a list or dict of patterns (see _combine_patterns), or an already
+        combined regex.  Each named group of a combined regex is one token type, owning the unnamed groups
+        that follow it.  Patterns that can't be combined are matched one at a time instead."""
+        if isinstance(patterns, re.Pattern):
+            self.regex: Optional[re.Pattern] = patterns
+            patterns = GROUP_TO_PATTERN
+        else:
+            patterns = _name_patterns(patterns)
+            self.regex = _combine_patterns(patterns)
+
+        self.patterns: List[re.Pattern] = list(patterns.values())
+        self.groups = {}
+        if self.regex is None:
+            # Each token's groups are all of the groups of its own match
+            self._named_patterns = patterns
+            self._finditer = self._finditer_separately
+            for name, p in patterns.items():
+                self.groups[name] = (p, slice(None))
+        else:
+            # Map each group name to its original pattern and the slice of the combined groups belonging to it
+            self._finditer = self.regex.finditer
+            indices = sorted(self.regex.groupindex.items(), key=lambda item: item[1])
+            for (name, i), (_, next_i) in zip(indices, indices[1:] + [(None, self.regex.groups + 1)]):
+                self.groups[name] = (patterns.get(name), slice(i, next_i - 1))
+
+    def _finditer_separately(self, text, pos=0):
+        # Search for each pattern on its own, keeping each one's next match in a heap ordered by start and then by
+        # pattern order, and yield the nearest match.  Matches that have been passed are searched for again.
+        heap = []
+        for i, (name, p) in enumerate(self._named_patterns.items()):
+            m = p.search(text, pos)
+            if m is not None:
+                heap.append((m.start(), i, name, p, m))
+        heapq.heapify(heap)
+
+        while heap:
+            start, i, name, p, m = heap[0]
+            if start < pos:
+                m = p.search(text, pos)
+                if m is None:
+                    heapq.heappop(heap)  # No more matches for this pattern
+                else:
+                    heapq.heapreplace(heap, (m.start(), i, name, p, m))
+                continue
+
+            yield _SeparateMatch(name, m)
+            pos = m.end()
+            if pos == start:
+                pos += 1  # Step past empty matches
+
+    def scan(self, text):
+        """Scan a piece of text by yielding (kind, text, start, end, match) tuples in order, where kind is the name of
+        the matched group, or None with no match for text that doesn't match any pattern.  This avoids creating
+        Token objects."""
+        i = 0
+        for m in self._finditer(text):
+            start, end = m.span()
+            if i < start:
+                yield None, text, i, start, None
+
+            i = end
+            yield m.lastgroup, text, start, end, m
+
+        # Yield one last no match span if text remains
+        if i < len(text):
+            yield None, text, i, len(text), None
+
+    def scan_stream(self, readable, chunk=1 << 20):
+        """Scan text read from readable in pieces of at most chunk characters without reading the whole text into
+        memory.  The text in each span is the piece it was found in.  A token reaching the end of the text read so
+        far is held back and matched again once more text is read, since it might continue into the next piece.
+        This yields the same spans as scan for the default tokenizer, but not for patterns whose match can change
+        depending on text past its end (e.g. an earlier alternative that is longer), or lookbehinds further back
+        than one character."""
+        finditer = self._finditer
+        text, i, done = '', 0, False
+
+        while not done:
+            data = readable.read(chunk)
+            done = not data
+
+            # Drop the scanned text, keeping one character before the rest so lookbehinds still work
+            if i:
+                text, i = text[i - 1:] + data, 1
+            else:
+                text += data
+
+            for m in finditer(text, i):
+                start, end = m.span()
+                if end == len(text) and not done:
+                    break
+
+                if i < start:
+                    yield None, text, i, start, None
+
+                i = end
+                yield m.lastgroup, text, start, end, m
+
+        # Yield one last no match span if text remains
+        if i < len(text):
+            yield None, text, i, len(text), None
 
     def tokenize(self, text):
         """Tokenize a piece of text by yielding Token objects in order, or a no match token"""
+        return self._to_tokens(self.scan(text))
+
+    def tokenize_stream(self, readable, chunk=1 << 20):
+        """Tokenize text read from readable in pieces of at most chunk characters, as in scan_stream."""
+        return self._to_tokens(self.scan_stream(readable, chunk))
 
-        # Convenience method to update the tokens list at the beginning and once per loop
-        def _update_token(pos, start, pattern, t):
-            if start >= pos:
-                return t  # Keep token if it hasn't been reached
+    def _to_tokens(self, spans):
+        for kind, text, start, end, m in spans:
+            if kind is None:
+                yield NoMatch(text, start, end)
             else:
-                m = pattern.search(text, pos)
-                if m is None:
-                    return None  # No more matches, delete this token from list
+                pattern, sub = self.groups[kind]
+                yield Token(pattern, text, start, end, m.groups()[sub], kind)
 
-                return Token(pattern, text, m.start(), m.end(), m.groups())  # Return new match
 
-        # Get the nearest position of all tokens in string
-        tokens = list(filter(None, map(lambda p: _update_token(0, -1, p, None), self.patterns)))
-        i = 0
+class _Stack:
+    """A queue with the deque interface used by filter functions.  Items are stored in reverse in a list so the
+    front of the queue is the end of the list, making the front operations plain list appends and pops.  append and
+    pop act on the back of the queue like a deque's, but take time proportional to the queue's length."""
+    __slots__ = ('_items', 'popleft', 'appendleft', 'extendleft')
 
-        while tokens and i < len(text):
-            # Get the closest match to the current position,
-            # yield a no match token if there is no token between the current position and match,
-            # then yield the matched token, move forward until end of token, and update token list
-            token = min(tokens, key=lambda t: t.start)
-            if i < token.start:
-                yield NoMatch(text, i, token.start)
+    def __init__(self, items=()):
+        self._items = list(items)
+        self._items.reverse()
+        self.popleft = self._items.pop
+        self.appendleft = self._items.append
+        self.extendleft = self._items.extend
 
-            yield token
-            i = token.end
-            tokens = list(filter(None, map(lambda t: _update_token(i, t.start, t.pattern, t), tokens)))
+    def append(self, item):
+        self._items.insert(0, item)
 
-        # Yield one last no match token if text remains
-        if i < len(text):
-            yield NoMatch(text, i, len(text))
+    def pop(self):
+        return self._items.pop(0)
+
+    def __getitem__(self, i: int):
+        return self._items[-1 - i]
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return reversed(self._items)
+
+    def __repr__(self):
+        return f"_Stack({list(self)!r})"
 
 
 class Node:
     """Parent class representing a node in the TeX AST."""
+    __slots__ = ('data', 'parent')
+    _is_group = False  # Cheaper to check than isinstance(n, GroupNode)
 
     def __init__(self, data=None):
         self.data: Optional[Any] = data
@@ -79,15 +247,25 @@ class Node:
         return f"{self.data}"
 
     def copy(self):
-        return copy.copy(self)
+        """Creates a copy of this node without a parent."""
+        n = Node.__new__(self.__class__)
+        n.data = self.data
+        n.parent = None
+        if self.__class__.__dictoffset__:
+            # Keep any attributes of subclasses that don't use __slots__
+            n.__dict__.update(self.__dict__)
+        return n
 
 
 class GroupNode(Node):
     """A Node containing a list of child nodes."""
+    __slots__ = ('children', '_has_alpha_cmd')
+    _is_group = True
 
     def __init__(self):
         super().__init__(None)
         self.children: List[Node] = []
+        self._has_alpha_cmd = False  # Whether an alphabetic command was below this node when it was copied
 
     def add(self, child):
         """Adds a child node to this node."""
@@ -96,150 +274,220 @@ class GroupNode(Node):
 
     def copy(self):
         """Creates a deep-copy of this node and all of its sub-nodes."""
-        new = self.__class__()
-        for c in self.children:
-            new.add(c.copy())
+        new = Node.__new__(self.__class__)
+        new.data = None
+        new.parent = None
+        if self.__class__.__dictoffset__:
+            new.__dict__.update(self.__dict__)
+        new.children = [c.copy() for c in self.children]
+
+        # Compute the alphabetic command flag from the copied children
+        has_alpha_cmd = False
+        for c in new.children:
+            c.parent = new
+            if has_alpha_cmd:
+                continue
+            elif c._is_group:
+                has_alpha_cmd = c._has_alpha_cmd
+            elif isinstance(c, CommandNode):
+                has_alpha_cmd = isinstance(c.data, str) and c.data[:1].isalpha()
+        new._has_alpha_cmd = has_alpha_cmd
         return new
 
     def take(self, node):
         """If node is a GroupNode, then take all of its child nodes.  Otherwise, add node as a child."""
 
         if isinstance(node, GroupNode):
+            self.children.extend(node.children)
             for c in node.children:
-                self.add(c)
+                c.parent = self
         else:
             self.add(node)
 
-    def filter(self, filter_func, should_copy=True):
+    def filter(self, filter_func, should_copy=True, descend=None):
         """
-        Recursively filter through the AST tree starting at this node, applying the function filter_func.
+        Filter depth-first through the AST tree starting at this node, applying the function filter_func.
 
         :param filter_func: is a function that takes two arguments.  The first is the current node in the
         tree, and the second is the remaining nodes that are queued up.  If the function returns None,
         the current node will be removed, otherwise the returned Node object will be added.
-        :param should_copy: determines whether the tree will first be copied, and defaults to true."""
+        :param should_copy: determines whether the tree will first be copied, and defaults to true.
+        :param descend: is an optional function that takes a GroupNode and returns whether to filter through
+        its children.  Groups it rejects are added back unchanged."""
 
-        def _do_filter(node, level=0):
-            if level > MAX_RECURSE_LEVEL:
-                raise ValueError("Max recursion level reached")
+        # Call the function on the root node, copying if required
+        root = filter_func(self.copy() if should_copy else self, _Stack())
+        if descend is not None and not descend(root):
+            return root
 
-            # Iterate through the object's children using a queue
-            children = deque(node.children)
-            node.children = []
+        # Walk the tree depth-first with an explicit stack holding each group being filtered, its queue of
+        # remaining children, and the group it is added to once all of its children have been filtered
+        stack = [(root, _Stack(root.children), None)]
+        root.children = []
 
-            while children:
-                n = children.popleft()
+        while stack:
+            node, children, parent = stack[-1]
 
+            while children:
                 # Call the function on the child node, adding the result back if returning a valid object
-                n = filter_func(n, children)
-                if isinstance(n, GroupNode):
-                    n = _do_filter(n, level + 1)
-                if n:
+                n = filter_func(children.popleft(), children)
+                if not n:
+                    continue
+                elif n._is_group and (descend is None or descend(n)):
+                    # Descend into the group before continuing with its siblings
+                    if len(stack) > MAX_RECURSE_LEVEL:
+                        raise ValueError("Max recursion level reached")
+
+                    stack.append((n, _Stack(n.children), node))
+                    n.children = []
+                    break
+                else:
                     node.add(n)
+            else:
+                stack.pop()
+                if parent is not None:
+                    parent.add(node)
 
-            return node
-
-        # Call the function on the root node, copying if required, then go up one node
-        obj = filter_func(self.copy() if should_copy else self, deque())
-        return _do_filter(obj)
+        return root
 
     def __str__(self):
-        return ''.join(map(str, self.children))
+        return ''.join([c.__str__() for c in self.children])
 
 
 # Tokenizer tokens
 TOKEN_COMMENT = re.compile(r"%(.*\n?)", re.MULTILINE)
-TOKEN_COMMAND = re.compile(r"\\([a-zA-Z@]{2,}|.)")
+TOKEN_COMMAND = re.compile(r"\\([a-zA-Z@]{2,}|(?s:.))")
 TOKEN_PARAMETER = re.compile(r"(#+)(\d)")
-TOKEN_LCB = re.compile(r"(?<!\\)\{")
-TOKEN_RCB = re.compile(r"(?<!\\)}")
-TOKEN_WHITESPACE = re.compile(r"(?<!\\)\s+")
-def_tokenizer = Tokenizer([TOKEN_COMMENT, TOKEN_COMMAND, TOKEN_PARAMETER,
-                           TOKEN_LCB, TOKEN_RCB, TOKEN_WHITESPACE])
+TOKEN_LCB = re.compile(r"\{")
+TOKEN_RCB = re.compile(r"}")
+TOKEN_WHITESPACE = re.compile(r"\s+")
+# TOKEN_COMMAND must come before the brace and whitespace patterns, so that it consumes escapes such as \{ and
+# escaped whitespace, including newlines, first and the others need no lookbehinds
+GROUP_TO_PATTERN = {'comment': TOKEN_COMMENT, 'command': TOKEN_COMMAND, 'parameter': TOKEN_PARAMETER,
+                    'lcb': TOKEN_LCB, 'rcb': TOKEN_RCB, 'whitespace': TOKEN_WHITESPACE}
+_MASTER_RE = _combine_patterns(GROUP_TO_PATTERN)
+def_tokenizer = Tokenizer(_MASTER_RE)
 
 
 # Latex-specific node types
 class TextNode(Node):
-    pass
+    __slots__ = ()
 
 
 class WhitespaceNode(Node):
-    pass
+    __slots__ = ()
 
 
 class CommandNode(Node):
     """A node reprenting a slash command."""
+    __slots__ = ()
+
     def __str__(self):
-        return f"\\{self.data}"
+        return '\\' + self.data
 
 
 class CommentNode(Node):
+    __slots__ = ()
+
     def __str__(self):
-        return f"%{self.data}"
+        return '%' + self.data
 
 
 class ParameterNode(Node):
     """A node representing a parameter in a macro definition, such as #1 or ####2."""
+    __slots__ = ('num_hashes', 'param')
+
     def __init__(self, num_hashes, param):
         super().__init__()
         self.num_hashes, self.param = num_hashes, param
 
+    def copy(self):
+        n = super().copy()
+        n.num_hashes, n.param = self.num_hashes, self.param
+        return n
+
     def __str__(self):
-        return f"{'#'*self.num_hashes}{self.param}"
+        return '#' * self.num_hashes + str(self.param)
 
 
 class BracketNode(GroupNode):
+    __slots__ = ()
+
     def __str__(self):
-        children_str = super().__str__()
-        return f"{{{children_str}}}"
+        return '{' + super().__str__() + '}'
 
 
-def to_ast(text: str = None, file=None, tokenizer=None):
-    """Convert the LaTeX source in text to an AST.  Returns a GroupNode containing the data."""
-    # Extract text from file if applicable
-    if (file is None) == (text is None):
-        raise ValueError("file and text can't both be set or unset!")
-    elif file is not None:
-        try:
-            text = file.read()
-        except AttributeError:
-            with open(file) as f:
-                text = f.read()
+# Node constructors for each token group that maps directly to a node, taking the text a token was found in and the
+# token's start and end.  Nothing is sliced out of the text unless the node stores it, and the few distinct
+# whitespace runs and command names that make up most tokens are interned so every node shares one string.
+_HANDLERS = {
+    None: lambda s, i, j: TextNode(s[i:j]),
+    'whitespace': lambda s, i, j: WhitespaceNode(sys.intern(s[i:j])),
+    'parameter': lambda s, i, j: ParameterNode(j - i - 1, int(s[j - 1])),
+    'comment': lambda s, i, j: CommentNode(s[i + 1:j]),
+    'command': lambda s, i, j: CommandNode(sys.intern(s[i + 1:j])),
+}
 
-    if not tokenizer:
-        tokenizer = def_tokenizer
 
-    # Iteratively build up the AST
+def _build_ast(spans):
+    # Iteratively build up the AST, dispatching on the name of the matched group.  Children are appended directly
+    # rather than through GroupNode.add, keeping the current group's append method at hand.
     curr = GroupNode()
-    for t in tokenizer.tokenize(text):
-        if isinstance(t, NoMatch):
-            curr.add(TextNode(t.get_text()))
-        elif t.pattern == TOKEN_WHITESPACE:
-            curr.add(WhitespaceNode(t.get_text()))
-        elif t.pattern == TOKEN_PARAMETER:
-            curr.add(ParameterNode(len(t.groups[0]), int(t.groups[1])))
-        elif t.pattern == TOKEN_LCB:
+    append = curr.children.append
+    handlers = _HANDLERS
+    for kind, text, start, end, _ in spans:
+        h = handlers.get(kind)
+        if h:
+            n = h(text, start, end)
+            n.parent = curr
+            append(n)
+        elif kind == 'lcb':
             n = BracketNode()
-            curr.add(n)
+            n.parent = curr
+            append(n)
             curr = n
-        elif t.pattern == TOKEN_RCB:
+            append = n.children.append
+        elif kind == 'rcb':
             if not isinstance(curr, BracketNode):
                 raise ValueError("Number of {s and }s don't match or the order is incorrect")
             curr = curr.parent
-        elif t.pattern == TOKEN_COMMENT:
-            curr.add(CommentNode(t.groups[0]))
-        elif t.pattern == TOKEN_COMMAND:
-            curr.add(CommandNode(t.groups[0]))
+            append = curr.children.append
         else:
             raise ValueError("Invalid token type")
 
     return curr
 
 
+def _parse(text, file, tokenizer, build):
+    # Scan text or a file, passing the spans to build and returning its result
+    if (file is None) == (text is None):
+        raise ValueError("file and text can't both be set or unset!")
+
+    if not tokenizer:
+        tokenizer = def_tokenizer
+
+    # Only the default tokenizer's patterns are known to scan the same when streamed, so read the whole file for
+    # any other tokenizer
+    if text is not None:
+        return build(tokenizer.scan(text))
+    elif hasattr(file, 'read'):
+        return build(tokenizer.scan_stream(file) if tokenizer is def_tokenizer else tokenizer.scan(file.read()))
+
+    with open(file) as f:
+        return build(tokenizer.scan_stream(f) if tokenizer is def_tokenizer else tokenizer.scan(f.read()))
+
+
+def to_ast(text: str = None, file=None, tokenizer=None):
+    """Convert the LaTeX source in text to an AST.  Returns a GroupNode containing the data.  With the default
+    tokenizer, a file, given either as a file object or a path, is tokenized as it is read instead of being read
+    into memory first."""
+    return _parse(text, file, tokenizer, _build_ast)
+
+
 def fix_whitespace(root: GroupNode):
     """Inserts a space between alphabetic backslash commands and text if none exists."""
 
-    def _fix_whitespace(n, children: deque):
+    def _fix_whitespace(n, children):
         if children:
             if isinstance(n, CommandNode) and n.data[0].isalpha():
                 if isinstance(children[0], TextNode) and children[0].data[0].isalpha():
@@ -249,14 +497,16 @@ def fix_whitespace(root: GroupNode):
 
         return n
 
-    return root.filter(_fix_whitespace)
+    # Only groups with an alphabetic command somewhere below them can need padding.  The tree must be copied first,
+    # since copying is what brings that flag up to date.
+    return root.filter(_fix_whitespace, should_copy=True, descend=lambda g: g._has_alpha_cmd)
 
 
 def clear_data(root):
     """Deletes any extra data stored in the GroupNode objects in the provided Node and its children."""
 
     def _clear_data(n, _):
-        if isinstance(n, GroupNode):
+        if n._is_group:
             n.data = None
 
         return n
@@ -264,21 +514,26 @@ def clear_data(root):
     return root.filter(_clear_data, False)
 
 
-def read_next(it: deque, error=True) -> Optional[Node]:
+# Node types skipped over by read_next, compared by exact type
+_SKIP_TYPES = frozenset({WhitespaceNode, CommentNode})
+
+
+def read_next(it, error=True) -> Optional[Node]:
     """Get the first non-whitespace, non-comment node in queue, possibly erroring if there was no Node found.
     Only return a single character if a TextNode was found."""
     try:
-        while True:
+        n = it.popleft()
+        while type(n) in _SKIP_TYPES:
             n = it.popleft()
-            if not (isinstance(n, WhitespaceNode) or isinstance(n, CommentNode)):
-                # If it's text, only return a single character
-                if isinstance(n, TextNode) and len(n.data) > 1:
-                    leftover = TextNode(data=n.data[1:])
-                    leftover.parent = n.parent
-                    it.appendleft(leftover)
-                    n = TextNode(data=n.data[0])
-
-                return n
+
+        # If it's text, only return a single character
+        if isinstance(n, TextNode) and len(n.data) > 1:
+            leftover = TextNode(data=n.data[1:])
+            leftover.parent = n.parent
+            it.appendleft(leftover)
+            n = TextNode(data=n.data[0])
+
+        return n
     except IndexError:
         if error:
             raise ValueError("Unexpected end of tokens")
@@ -0,0 +1,159 @@
+from array import array
+from typing import List
+
+from .ast import *
+from .ast import _parse
+
+__all__ = ['KIND_GROUP', 'KIND_TEXT', 'KIND_WHITESPACE', 'KIND_COMMAND', 'KIND_COMMENT', 'KIND_PARAMETER',
+           'KIND_BRACKET', 'SoATree', 'to_ast_soa', 'soa_to_str']
+
+# Node kinds, in the kind array
+KIND_GROUP = 0
+KIND_TEXT = 1
+KIND_WHITESPACE = 2
+KIND_COMMAND = 3
+KIND_COMMENT = 4
+KIND_PARAMETER = 5
+KIND_BRACKET = 6
+
+# Text written before the data of each kind of node
+_PREFIXES = {KIND_TEXT: '', KIND_WHITESPACE: '', KIND_COMMAND: '\\', KIND_COMMENT: '%', KIND_PARAMETER: ''}
+
+# Node classes of the kinds that only store their data
+_NODE_TYPES = {KIND_TEXT: TextNode, KIND_WHITESPACE: WhitespaceNode, KIND_COMMAND: CommandNode,
+               KIND_COMMENT: CommentNode}
+
+# Kinds of the span names produced by the tokenizer, along with the part of the span stored as the node's data
+_SPAN_KINDS = {None: (KIND_TEXT, 0), 'whitespace': (KIND_WHITESPACE, 0), 'command': (KIND_COMMAND, 1),
+               'comment': (KIND_COMMENT, 1), 'parameter': (KIND_PARAMETER, 0)}
+
+
+class SoATree:
+    """A TeX AST stored as a struct of arrays rather than as Node objects.  Node i has the kind kind[i], and its
+    data is strings[data_idx[i]], or nothing if data_idx[i] is -1.  Nodes are stored in document order, so a
+    node's children come after it, and are linked through parent, first_child and next_sibling, which are -1
+    where there is no such node.  Node 0 is the root group."""
+
+    def __init__(self):
+        self.kind = array('B', [KIND_GROUP])
+        self.data_idx = array('i', [-1])
+        self.parent = array('i', [-1])
+        self.first_child = array('i', [-1])
+        self.next_sibling = array('i', [-1])
+        self.strings: List[str] = []
+        self._string_idx = {}
+
+    def __len__(self):
+        return len(self.kind)
+
+    def append(self, kind, data, parent, prev_sibling):
+        """Adds a node after all existing nodes, returning its index.  data may be None, and prev_sibling is the
+        index of the parent's current last child, or -1 if it has none."""
+        i = len(self.kind)
+        if data is None:
+            idx = -1
+        else:
+            # Store each distinct string once
+            idx = self._string_idx.get(data)
+            if idx is None:
+                idx = self._string_idx[data] = len(self.strings)
+                self.strings.append(data)
+
+        self.kind.append(kind)
+        self.data_idx.append(idx)
+        self.parent.append(parent)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+
+        if prev_sibling == -1:
+            self.first_child[parent] = i
+        else:
+            self.next_sibling[prev_sibling] = i
+
+        return i
+
+    def children(self, i):
+        """Yield the indices of the children of node i."""
+        c = self.first_child[i]
+        while c != -1:
+            yield c
+            c = self.next_sibling[c]
+
+    def to_node(self) -> GroupNode:
+        """Convert to the equivalent tree of Node objects."""
+        kinds, data_idx, parents, strings = self.kind, self.data_idx, self.parent, self.strings
+        nodes = [GroupNode()]
+
+        for i in range(1, len(kinds)):
+            k = kinds[i]
+            if k == KIND_BRACKET:
+                n = BracketNode()
+            elif k == KIND_PARAMETER:
+                s = strings[data_idx[i]]
+                n = ParameterNode(len(s) - 1, int(s[-1]))
+            else:
+                n = _NODE_TYPES[k](strings[data_idx[i]])
+
+            nodes[parents[i]].add(n)
+            nodes.append(n)
+
+        return nodes[0]
+
+    def __str__(self):
+        return soa_to_str(self)
+
+
+def _build_soa(spans):
+    tree = SoATree()
+    append = tree.append
+    span_kinds = _SPAN_KINDS
+
+    # The open groups, and the last child added to each of them
+    groups, last = [0], [-1]
+    for kind, text, start, end, _ in spans:
+        k = span_kinds.get(kind)
+        if k:
+            last[-1] = append(k[0], text[start + k[1]:end], groups[-1], last[-1])
+        elif kind == 'lcb':
+            i = last[-1] = append(KIND_BRACKET, None, groups[-1], last[-1])
+            groups.append(i)
+            last.append(-1)
+        elif kind == 'rcb':
+            if len(groups) == 1:
+                raise ValueError("Number of {s and }s don't match or the order is incorrect")
+            groups.pop()
+            last.pop()
+        else:
+            raise ValueError("Invalid token type")
+
+    return tree
+
+
+def to_ast_soa(text: str = None, file=None, tokenizer=None) -> SoATree:
+    """Convert the LaTeX source in text or a file to an SoATree, as with to_ast."""
+    return _parse(text, file, tokenizer, _build_soa)
+
+
+def soa_to_str(tree: SoATree) -> str:
+    """Convert an SoATree back into LaTeX source in a single pass over its arrays."""
+    kinds, data_idx, parents, strings = tree.kind, tree.data_idx, tree.parent, tree.strings
+    prefixes = _PREFIXES
+    pieces = []
+
+    # Close brackets once the next node is no longer inside them
+    groups = [0]
+    for i in range(1, len(kinds)):
+        p = parents[i]
+        while groups[-1] != p:
+            groups.pop()
+            pieces.append('}')
+
+        k = kinds[i]
+        if k == KIND_BRACKET:
+            pieces.append('{')
+            groups.append(i)
+        else:
+            pieces.append(prefixes[k] + strings[data_idx[i]])
+
+    pieces.append('}' * (len(groups) - 1))
+    return ''.join(pieces)
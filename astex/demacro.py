@@ -6,7 +6,6 @@
 
 
 from .ast import *
-from collections import deque
 from inspect import signature
 
 __all__ = ['Demacro']
@@ -23,7 +22,7 @@ def _filter_children(node, filter_ws=True):
     return None
 
 
-def _read_until_end_bracket(it: deque):
+def _read_until_end_bracket(it):
     node = GroupNode()
 
     while True:
@@ -96,21 +95,64 @@ def _get_bracket_args(it):
     return args, default, temp
 
 
-def _replace_parameters(root: GroupNode, params):
-    def _do_replace(n, _):
+def _compile_body(node):
+    """Flatten the children of a macro body into a template, which is a list of ('lit', node) entries for nodes
+    without parameters, ('param', index) entries for parameters to substitute, and ('group', node, template)
+    entries for groups containing parameters.  Doubled hashes are halved here, once per definition."""
+    template = []
+    for n in node.children:
         if isinstance(n, ParameterNode):
             if n.num_hashes == 1:
-                # Replace with parameter value
-                n.parent.take(params[n.param - 1].copy())
-                return None
+                template.append(('param', n.param - 1))
+            elif n.num_hashes % 2:
+                raise ValueError("Number of hashes in parameter must be power of 2")
+            else:
+                template.append(('lit', ParameterNode(n.num_hashes // 2, n.param)))
+        elif isinstance(n, GroupNode):
+            sub = _compile_body(n)
+            if all(op[0] == 'lit' and op[1] is c for op, c in zip(sub, n.children)):
+                template.append(('lit', n))
+            else:
+                template.append(('group', n, sub))
+        else:
+            template.append(('lit', n))
+
+    return template
+
+
+def _expand_template(template, params):
+    """Create the nodes of a macro expansion from its template and the read-in parameters, returning the list of
+    top-level nodes.  Nested groups are filled in using an explicit stack of template iterators."""
+    root = GroupNode()
+    stack = [(iter(template), root)]
+
+    while stack:
+        ops, group = stack[-1]
+        for op in ops:
+            if op[0] == 'lit':
+                group.add(op[1].copy())
+            elif op[0] == 'param':
+                # Replace with parameter value, unwrapping groups
+                p = params[op[1]]
+                if isinstance(p, GroupNode):
+                    for c in p.children:
+                        group.add(c.copy())
+                else:
+                    group.add(p.copy())
             else:
-                n.num_hashes /= 2
-                if int(n.num_hashes) != n.num_hashes:
-                    raise ValueError("Number of hashes in parameter must be power of 2")
+                # Fill in the group before continuing with its siblings
+                sub = op[1].__class__()
+                group.add(sub)
+                stack.append((iter(op[2]), sub))
+                break
+        else:
+            stack.pop()
+
+    return root.children
 
-        return n
 
-    return root.filter(_do_replace)
+def _make_macro(args, default, body):
+    return {'args': args, 'default': default, 'body': body, 'template': _compile_body(body)}
 
 
 def _expand_macro(it, data, parent):
@@ -141,17 +183,27 @@ def _expand_macro(it, data, parent):
 
     # Replace the parameter tokens with the read-in parameters
     if callable(data['body']):
-        temp = data['body'](*tokens)
+        expansion = data['body'](*tokens).children
     else:
-        temp = _replace_parameters(data['body'], tokens)
+        expansion = _expand_template(data['template'], tokens)
 
-    for c in reversed(temp.children):
+    for c in reversed(expansion):
         # Add to front of queue to process expansion
         # Has to be done in reverse because appendleft reverses order
         c.parent = parent
         it.appendleft(c)
 
 
+def _own_macros(group_data):
+    # Only copy the macros dict inherited by a group the first time the group defines a macro,
+    # to avoid having to make many copies of the macros dict
+    if not group_data['copied']:
+        group_data['copied'] = True
+        group_data['macros'] = group_data['macros'].copy()
+
+    return group_data['macros']
+
+
 def _process(n, children):
     if not n.parent:
         return n
@@ -161,14 +213,6 @@ def _process(n, children):
         n.parent.data = {'macros': n.parent.parent.data['macros'], 'copied': False}
     macros = n.parent.data['macros']
 
-    def _check_macros():
-        # This is to avoid having to make many copies of the macros dict
-        nonlocal macros
-        if not n.parent.data['copied']:
-            n.parent.data['copied'] = True
-            macros = macros.copy()
-            n.parent.data['macros'] = macros
-
     # Define or insert macros or environments
     if isinstance(n, CommandNode):
         if n.data in ('newcommand', 'renewcommand', 'providecommand'):
@@ -177,13 +221,13 @@ def _process(n, children):
             args, default, temp = _get_bracket_args(children)
             body = GroupNode()
             body.take(temp)
-            data = {'args': args, 'default': default, 'body': body}
+            data = _make_macro(args, default, body)
 
             # Add data to macros dict
             if n.data == 'newcommand' and name in macros:
                 raise ValueError("Newcommand used for existing command")
             elif n.data != 'providecommand' or name not in macros:
-                _check_macros()
+                macros = _own_macros(n.parent.data)
                 macros[name] = data
 
             return None
@@ -208,9 +252,9 @@ def _process(n, children):
             if n.data == 'newenvironment' and name in macros:
                 raise ValueError("Newenvironment used for existing environment")
             else:
-                _check_macros()
-                macros[name] = {'args': args, 'default': default, 'body': begin_body}
-                macros[f"end{name}"] = {'args': 0, 'default': None, 'body': end_body}
+                macros = _own_macros(n.parent.data)
+                macros[name] = _make_macro(args, default, begin_body)
+                macros[f"end{name}"] = _make_macro(0, None, end_body)
 
             return None
         elif n.data in macros:
@@ -260,7 +304,7 @@ class Demacro:
         using this function."""
 
         for k, v in macros.items():
-            macro = {'args': 0, 'default': None}
+            macro = {'args': 0, 'default': None, 'template': None}
 
             # Handle body argument, valid options: LaTeX text or a custom function
             if callable(v['body']):
@@ -270,6 +314,7 @@ class Demacro:
                 body = GroupNode()
                 temp = to_ast(text=v['body'])
                 body.take(temp)
+                macro['template'] = _compile_body(body)
 
             macro['body'] = body
 
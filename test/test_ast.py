@@ -1,8 +1,11 @@
 import unittest
+import io
 import os
+import re
 import time
 
 from astex.ast import *
+from astex.ast import def_tokenizer, Tokenizer, TOKEN_WHITESPACE
 
 LATEX_TEST = r"""
 \newcommand{\test}[1]{Hello, #1!}  % Test command
@@ -75,3 +78,130 @@ class TestAST(unittest.TestCase):
         finally:
             os.remove(filename)
 
+    def test_stream(self):
+        # Reading in small chunks splits tokens across chunk boundaries
+        def _tokens(it):
+            return [(t.lastgroup, t.get_text(), t.groups) for t in it]
+
+        expected = _tokens(def_tokenizer.tokenize(LATEX_TEST))
+        for chunk in (1, 2, 5, 64):
+            self.assertEqual(_tokens(def_tokenizer.tokenize_stream(io.StringIO(LATEX_TEST), chunk)), expected)
+
+    def test_whitespace(self):
+        # Whitespace after an escaped backslash is still whitespace, while an escaped space is a command
+        root = to_ast(text=r"\\ a\ b")
+        self.assertEqual([type(n) for n in root.children],
+                         [CommandNode, WhitespaceNode, TextNode, CommandNode, TextNode])
+        self.assertEqual(root.children[3].data, ' ')
+
+    def test_fix_whitespace_nested(self):
+        # Groups are only searched if they have an alphabetic command below them
+        root, inner = GroupNode(), BracketNode()
+        root.add(TextNode("a"))
+        root.add(inner)
+        inner.add(BracketNode())
+        inner.add(CommandNode("foo"))
+        inner.add(TextNode("bar"))
+        self.assertEqual(str(fix_whitespace(root)), r"a{{}\foo bar}")
+        self.assertEqual(str(fix_whitespace(to_ast(text=r"{\@}a{\,}b"))), r"{\@}a{\,}b")
+
+    def test_escapes(self):
+        # Escaped braces are commands, while a brace after an escaped backslash opens or closes a group
+        root = to_ast(text=r"\{a\}\\{b}")
+        self.assertEqual([type(n) for n in root.children],
+                         [CommandNode, TextNode, CommandNode, CommandNode, BracketNode])
+        self.assertEqual([root.children[0].data, root.children[2].data, root.children[3].data], ['{', '}', '\\'])
+        self.assertEqual(str(root), r"\{a\}\\{b}")
+
+        # An escaped newline is a command too
+        root = to_ast(text="a\\\nb")
+        self.assertEqual([type(n) for n in root.children], [TextNode, CommandNode, TextNode])
+        self.assertEqual(root.children[1].data, '\n')
+        self.assertEqual(str(root), "a\\\nb")
+
+    def test_custom_tokenizer(self):
+        def _tokens(tokenizer, text):
+            return [(t.get_text(), t.groups, t.pattern) for t in tokenizer.tokenize(text)]
+
+        # Each pattern keeps its own flags when combined
+        upper, lower = re.compile("A"), re.compile("b", re.IGNORECASE)
+        self.assertEqual(_tokens(Tokenizer([upper, lower]), "aB"), [("a", None, None), ("B", (), lower)])
+
+        # Patterns with backreferences, global flags or named groups are matched one at a time
+        quoted, foo = re.compile(r"(['\"]).*?\1"), re.compile(r"(?i)foo")
+        self.assertEqual(_tokens(Tokenizer([quoted, TOKEN_WHITESPACE, foo]), "'a\"' Foo"),
+                         [("'a\"'", ("'",), quoted), (" ", (), TOKEN_WHITESPACE), ("Foo", (), foo)])
+
+        first, second = re.compile(r"(?P<q>a)"), re.compile(r"(?P<q>b)")
+        self.assertEqual(_tokens(Tokenizer([first, second]), "cba"),
+                         [("c", None, None), ("b", ("b",), second), ("a", ("a",), first)])
+
+    def test_copy_subclass(self):
+        # Attributes of subclasses without __slots__ are copied too
+        class MyCmd(CommandNode):
+            def __init__(self, data, extra):
+                super().__init__(data)
+                self.extra = extra
+
+        class MyGroup(GroupNode):
+            def __init__(self):
+                super().__init__()
+                self.extra = []
+
+        root = MyGroup()
+        root.extra.append(1)
+        root.add(MyCmd("foo", "bar"))
+        new = root.copy()
+        self.assertIsNot(new.children[0], root.children[0])
+        self.assertEqual(new.children[0].extra, "bar")
+        self.assertEqual(new.extra, [1])
+
+    def test_filter_queue(self):
+        # The queue of remaining nodes behaves like a deque at both ends
+        def _drop_last(n, children):
+            if isinstance(n, TextNode) and n.data == 'a':
+                self.assertEqual(children.pop().data, 'c')
+                self.assertEqual([c.data for c in children], [' ', 'b', ' '])
+                children.append(TextNode('d'))
+            return n
+
+        self.assertEqual(str(to_ast(text="a b c").filter(_drop_last)), "a b d")
+
+    def test_fix_whitespace_changed(self):
+        # Trees changed without using add are still padded
+        inner = BracketNode()
+        inner.children = [CommandNode('foo'), TextNode('bar')]
+        root = GroupNode()
+        root.add(inner)
+        self.assertEqual(str(fix_whitespace(root)), r"{\foo bar}")
+
+        root = GroupNode()
+        root.add(CommandNode('@'))
+        root.add(TextNode('x'))
+        root.children[0].data = 'foo'
+        self.assertEqual(str(fix_whitespace(root)), r"\foo x")
+
+        # Commands without data can still be added and copied
+        root = GroupNode()
+        root.add(CommandNode())
+        root.add(BracketNode())
+        self.assertFalse(root.copy()._has_alpha_cmd)
+
+    def test_stream_custom_tokenizer(self):
+        # A file that returns a few characters per read is read whole for tokenizers other than the default one
+        class _SmallReads(io.StringIO):
+            def read(self, size=-1):
+                return super().read(size if size < 0 else min(size, 3))
+
+        text = r"\begin x\b"
+        tokenizer = Tokenizer({'command': re.compile(r"\\(begin|b)"), 'whitespace': TOKEN_WHITESPACE})
+        expected = [type(n) for n in to_ast(text=text, tokenizer=tokenizer).children]
+        self.assertEqual(expected, [CommandNode, WhitespaceNode, TextNode, CommandNode])
+        self.assertEqual([type(n) for n in to_ast(file=_SmallReads(text), tokenizer=tokenizer).children], expected)
+        self.assertEqual(str(to_ast(file=_SmallReads(LATEX_TEST))), LATEX_TEST)
+
+    def test_parameter_str(self):
+        p = ParameterNode(2, 1)
+        self.assertEqual(str(p), "##1")
+        p.num_hashes = 1
+        self.assertEqual(str(p), "#1")
@@ -0,0 +1,37 @@
+import unittest
+import io
+
+from astex.ast import to_ast
+from astex.ast_soa import *
+
+LATEX_TEST = r"""
+\newcommand{\test}[1]{Hello, #1!}  % Test command
+\test{world}{}{{\a}b}
+
+\upper{in-between}lowercase ##2 \{ \\
+"""
+
+
+def _dump(n):
+    children = [_dump(c) for c in getattr(n, 'children', [])]
+    return type(n).__name__, n.data, getattr(n, 'num_hashes', None), getattr(n, 'param', None), children
+
+
+class TestASTSoA(unittest.TestCase):
+    def test(self):
+        tree = to_ast_soa(text=LATEX_TEST)
+        self.assertEqual(soa_to_str(tree), LATEX_TEST)
+        self.assertEqual(_dump(tree.to_node()), _dump(to_ast(text=LATEX_TEST)))
+        self.assertEqual(soa_to_str(to_ast_soa(file=io.StringIO(LATEX_TEST))), LATEX_TEST)
+
+    def test_links(self):
+        tree = to_ast_soa(text=r"a{\b c}%d")
+        self.assertEqual([tree.kind[i] for i in tree.children(0)], [KIND_TEXT, KIND_BRACKET, KIND_COMMENT])
+
+        bracket = tree.next_sibling[tree.first_child[0]]
+        self.assertEqual([tree.strings[tree.data_idx[i]] for i in tree.children(bracket)], ['b', ' ', 'c'])
+        self.assertEqual(tree.parent[tree.first_child[bracket]], bracket)
+
+    def test_unbalanced(self):
+        with self.assertRaises(ValueError):
+            to_ast_soa(text="a}")